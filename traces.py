@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+StatPro trace summary (reads traces.jsonl written by main.py).
+Run: python traces.py [traces.jsonl] [-n 10] [--name cb:profile]
+"""
+
+import argparse
+import json
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+
+def load(path: Path, name: str = ""):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try: tr = json.loads(line)
+            except ValueError: continue
+            if not name or tr.get("name") == name: yield tr
+
+
+def pct(vals, p: float) -> float:
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(len(vals) * p))] if vals else 0.0
+
+
+def summarize(traces, top: int):
+    traces = list(traces)
+    if not traces: return print("❌ Нет трейсов")
+
+    print(f"🐢 Slowest {min(top, len(traces))} of {len(traces)} traces:")
+    for tr in sorted(traces, key=lambda t: t["dur_ms"], reverse=True)[:top]:
+        print(f"  {tr['dur_ms']:9.1f}ms  {tr['name']}  [{tr['id']}]")
+        depth = {0: 0}
+        for sp in tr["spans"]:
+            depth[sp["id"]] = depth.get(sp["parent"], 0) + 1
+            print(f"    {'  ' * depth[sp['id']]}+{sp['at_ms']:.1f}ms {sp['name']} {sp.get('dur_ms', 0):.1f}ms")
+
+    # Per span name: count, total, avg, p95 and share of the traced wall time
+    spans = defaultdict(list)
+    for tr in traces:
+        for sp in tr["spans"]: spans[sp["name"]].append(sp.get("dur_ms", 0))
+    wall = sum(t["dur_ms"] for t in traces) or 1
+    print(f"\n📊 Spans ({wall:.1f}ms traced):")
+    print(f"  {'span':<36}{'count':>7}{'total ms':>11}{'avg ms':>9}{'p95 ms':>9}{'share':>8}")
+    for n, d in sorted(spans.items(), key=lambda kv: sum(kv[1]), reverse=True):
+        print(f"  {n:<36}{len(d):>7}{sum(d):>11.1f}{sum(d)/len(d):>9.2f}{pct(d, .95):>9.2f}{sum(d)/wall:>8.1%}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Summarize StatPro traces")
+    ap.add_argument("path", nargs="?", default=str(Path(__file__).resolve().parent / "traces.jsonl"))
+    ap.add_argument("-n", "--top", type=int, default=10, help="slowest traces to show")
+    ap.add_argument("--name", default="", help="only traces with this root name, e.g. cb:profile")
+    a = ap.parse_args()
+    if not Path(a.path).exists(): sys.exit(f"❌ {a.path} не найден")
+    summarize(load(Path(a.path), a.name), a.top)
+
+
+if __name__ == "__main__":
+    main()